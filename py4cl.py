@@ -10,27 +10,43 @@
 from __future__ import print_function
 
 import sys
+import io
 import numbers
+import functools
 import itertools
 import inspect
 import json
 import os
-import signal
 import traceback
 import threading
 
-numpy_is_installed = False
+# NumPy is used for multi-dimensional arrays, but importing it costs a
+# noticeable fraction of startup time. Only detect its availability
+# here; the import itself happens in init_numpy, the first time the
+# session actually touches numpy.
+numpy_is_loaded = False
 try:
-	# Use NumPy for multi-dimensional arrays
-	import numpy
-	numpy_is_installed = True
+	import importlib.util
+	numpy_is_installed = importlib.util.find_spec("numpy") is not None
 except:
-	pass
+	numpy_is_installed = False
 
-return_stream = sys.stdout
+# Write messages to the binary layer of stdout through a 64KB buffer of
+# our own: this skips the text codec on every write, and (since python
+# is run with -u, leaving the binary layer unbuffered) lets one flush
+# per message reach lisp in a single syscall.
+return_stream = io.BufferedWriter(sys.stdout.buffer, buffer_size = 65536)
 output_stream = sys.stderr
 sys.stdout = sys.stderr
 
+# Read messages through a 64KB buffer of our own as well. The length
+# header sent by lisp counts characters, so reads stay on a text layer;
+# the BufferedReader underneath coalesces the header line, the payload
+# and the one-byte command reads into bulk syscalls.
+input_stream = io.TextIOWrapper(
+	io.BufferedReader(sys.stdin.buffer.raw, buffer_size = 65536),
+	encoding = "utf-8")
+
 config = {}
 
 # eval_globals store the environment used
@@ -184,10 +200,12 @@ python_to_lisp_type = {
 	str        : "STRING",
 }
 
-try:
-	python_to_lisp_type[inspect._empty] = "NIL"
-except:
-	pass
+python_to_lisp_type[inspect._empty] = "NIL"
+
+# Full (quote ...) strings precomputed and interned so that lispifying
+# a type object is a single dict lookup
+lispified_types = {key: sys.intern("(quote " + value + ")")
+				   for key, value in python_to_lisp_type.items()}
 
 return_values = 0
 
@@ -201,17 +219,17 @@ return_values = 0
 
 def lispify_dict(dict):
 	segment_  = "(cl::setf (cl::gethash (cl::quote {}) table) (cl::quote {}))"
-	segments  = [segment_.format(lispify(key), lispify(value)) for key, value in dict.items()]
+	segments  = [segment_.format(_lispify(key), _lispify(value)) for key, value in dict.items()]
 	segment_0 = "#.(cl::let ((table (cl::make-hash-table :test (cl::quote cl::equal)))) "
 	segment_1 = " ".join(segments)
 	segment_2 = " table)"
-	return segment_0 + segment_1 + segment_2
+	return "".join([segment_0, segment_1, segment_2])
 
 def lispify_tuple(tuple):
 	if len(tuple) == 0:
 		return "\"()\""
 	else:
-		return "(quote (" + " ".join(lispify(elt) for elt in tuple) + "))"
+		return "".join(["(quote (", " ".join([_lispify(elt) for elt in tuple]), "))"])
 
 def lispify_infnan_if_needed (lispified_float):
 	infnan = {"infd0" : "float-features:double-float-positive-infinity",
@@ -233,23 +251,27 @@ def lispify_float (float):
 	return lispify_infnan_if_needed(lispified_float)
 
 def lispify_exception (obj):
-	if config["printPythonTraceback"]:
+	if config.get("printPythonTraceback"):
 		return "".join(traceback.format_exception(type(obj), obj, obj.__traceback__))
 	else:
 		return str(obj)
 
+# Translation table to escape backslashes and double quotes for the
+# lisp reader in a single pass over the string
+string_escape_table = str.maketrans({"\\": "\\\\", "\"": "\\\""})
+
 lispifiers = {
 	bool              : lambda x: "T" if x else "NIL",
 	type(None)        : lambda x: "\"None\"", # Better be "NIL"..?
 	int               : str,
 	fractions.Fraction: str,
 	float             : lispify_float, # floats in python are double-floats of common-lisp
-	complex           : lambda x: "#C(" + lispify(x.real) + " " + lispify(x.imag) + ")",
-	list              : lambda x: "#(" + " ".join(lispify(elt) for elt in x) + ")",
+	complex           : lambda x: "".join(["#C(", _lispify(x.real), " ", _lispify(x.imag), ")"]),
+	list              : lambda x: "".join(["#(", " ".join([_lispify(elt) for elt in x]), ")"]),
 	tuple             : lispify_tuple,
 	dict              : lispify_dict,
-	str               : lambda x: "\"" + x.replace("\\", "\\\\").replace("\"", "\\\"")  + "\"",
-	type              : lambda x: "(quote " + python_to_lisp_type[x] + ")",
+	str               : lambda x: "\"" + x.translate(string_escape_table) + "\"",
+	type              : lambda x: lispified_types[x],
 	Symbol            : str,
 	UnknownLispObject : lambda x: "#.(py4cl2::lisp-object {})".format(x.handle),
 }
@@ -258,9 +280,26 @@ if numpy_is_installed: #########################################################
 	NUMPY_PICKLE_INDEX = 0 # optional increment in ndarray_lispifier and reset to 0
 
 	def load_pickled_ndarray(filename):
-		arr = numpy.load(filename, allow_pickle = True)
+		# The file is written by numpy-file-format:store-array on the
+		# lisp side, which never pickles objects
+		init_numpy()
+		arr = numpy.load(filename, allow_pickle = False)
 		return arr
 
+	def ndarray_from_text(data, dtype, dimensions):
+		"""Build an ndarray from a space-separated string of numbers.
+
+		Used by the lisp side to transfer numeric arrays: numpy parses
+		the data string in C, instead of eval parsing a nested python
+		list literal element by element."""
+		init_numpy()
+		if dtype == "bool":
+			# bool(str) is true for any non-empty string; parse the
+			# 0/1 elements numerically first
+			return numpy.array(data.split(), dtype = "uint8") \
+						.astype("bool").reshape(dimensions)
+		return numpy.array(data.split(), dtype = dtype).reshape(dimensions)
+
 	def delete_numpy_pickle_arrays():
 		global NUMPY_PICKLE_INDEX
 		while NUMPY_PICKLE_INDEX:
@@ -270,20 +309,7 @@ if numpy_is_installed: #########################################################
 			if os.path.exists(numpy_pickle_location):
 				os.remove(numpy_pickle_location)
 
-	numpy_cl_type = {
-		numpy.dtype("int64"): "(cl:quote (cl:signed-byte 64))",
-		numpy.dtype("int32"): "(cl:quote (cl:signed-byte 32))",
-		numpy.dtype("int16"): "(cl:quote (cl:signed-byte 16))",
-		numpy.dtype("int8"):  "(cl:quote (cl:signed-byte 8))",
-		numpy.dtype("uint64"): "(cl:quote (cl:unsigned-byte 64))",
-		numpy.dtype("uint32"): "(cl:quote (cl:unsigned-byte 32))",
-		numpy.dtype("uint16"): "(cl:quote (cl:unsigned-byte 16))",
-		numpy.dtype("uint8"):  "(cl:quote (cl:unsigned-byte 8))",
-		numpy.dtype("bool_"): "(cl:quote cl:bit)",
-		numpy.dtype("float64"): "(cl:quote cl:double-float)",
-		numpy.dtype("float32"): "(cl:quote cl:single-float)",
-		numpy.dtype("object"): "cl:t",
-	}
+	numpy_cl_type = {} # filled in by init_numpy, keyed on numpy dtypes
 
 	def numpy_to_cl_type(numpy_type):
 		try:
@@ -291,6 +317,20 @@ if numpy_is_installed: #########################################################
 		except KeyError:
 			raise Exception("Do not know how to convert {0} to CL.".format(str(numpy_type)))
 
+	def numpy_element_formatter(dtype):
+		"""Return an array2string formatter dict for DTYPE, or None if the
+		elements must go through the per-element lispify fallback."""
+		if dtype.kind in "iu":
+			return {"int_kind": str}
+		elif dtype == numpy.dtype("float64"):
+			return {"float_kind": lispify_float}
+		elif dtype == numpy.dtype("float32"):
+			return {"float_kind": lambda x: lispify_infnan_if_needed(str(x))}
+		elif dtype.kind == "b":
+			return {"bool": lambda x: "1" if x else "0"}
+		else:
+			return None
+
 	def lispify_ndarray (obj):
 		"""Convert a NumPy array to a string which can be read by lisp
 		Example:
@@ -298,27 +338,40 @@ if numpy_is_installed: #########################################################
 			   [3, 4]])
 		"""
 		global NUMPY_PICKLE_INDEX
+		# Object arrays would need pickling, which numpy-file-format
+		# cannot read on the lisp side; they take the string path below
 		if "numpyPickleLowerBound" in config and \
 		   "numpyPickleLocation" in config and \
-		   obj.size >= config["numpyPickleLowerBound"]:
+		   obj.size >= config["numpyPickleLowerBound"] and \
+		   obj.dtype.kind != "O":
 			numpy_pickle_location = config["numpyPickleLocation"] \
 				+ ".from." + str(NUMPY_PICKLE_INDEX)
 			NUMPY_PICKLE_INDEX += 1
 			with open(numpy_pickle_location, "wb") as f:
-				numpy.save(f, obj, allow_pickle = True)
+				numpy.save(f, obj, allow_pickle = False)
 			array = "#.(numpy-file-format:load-array \"" + numpy_pickle_location + "\")"
 			return array
 		if obj.ndim == 0:
 			# Convert to scalar then lispify
-			return lispify(obj.item())
+			return _lispify(obj.item())
 		# First convert to 1d array, then ask lisp to reshape
 		# FIXME: Will this play nice with both row-major and column-major arrays?
-		initial_contents = "(cl:list {0})".format(
-			" ".join(map(lispify, numpy.ndarray.flatten(obj)))
-		)
+		# ravel returns a view for contiguous arrays, where flatten
+		# would always copy
+		flat = obj.ravel()
+		formatter = numpy_element_formatter(obj.dtype)
+		if formatter is not None:
+			# Format the whole array in one array2string pass instead of
+			# dispatching through lispify once per element
+			elements = numpy.array2string(
+				flat, separator = " ", threshold = sys.maxsize,
+				max_line_width = sys.maxsize, formatter = formatter)[1:-1]
+		else:
+			elements = " ".join(map(_lispify, flat))
+		initial_contents = "(cl:list {0})".format(elements)
 		element_type = numpy_to_cl_type(obj.dtype)
 		total_size = str(obj.size)
-		dimensions = lispify(obj.shape)
+		dimensions = _lispify(obj.shape)
 		array_1d = "(cl:make-array {0} :element-type {1} :initial-contents {2})".format(
 			total_size, element_type, initial_contents
 		)
@@ -328,27 +381,60 @@ if numpy_is_installed: #########################################################
 		  )
 		return displaced_array
 
-	# Register the handler to convert Python -> Lisp strings
-	#
-	# The case for integers is handled inside lispify
-	# function. At best, you would want a way to compare /
-	# check for subtypes to avoid casing on u/int64/32/16/8.
-	lispifiers.update({
-		numpy.ndarray: lispify_ndarray,
-		numpy.float64: lispify_float,
-		numpy.float32: lambda x : lispify_infnan_if_needed(str(x)),
-		numpy.bool_  : lambda x : "1" if x else "0"})
+	def init_numpy():
+		"""Import numpy and register the numpy lispifiers.
+
+		Called the first time numpy becomes relevant to the session
+		(through the _py4cl_numpy proxy, a pickled array file, or a
+		numpy object reaching lispify), so that sessions which never
+		touch arrays skip the import cost."""
+		global numpy, numpy_is_loaded
+		if numpy_is_loaded:
+			return
+		import numpy
+		numpy_is_loaded = True
+		numpy_cl_type.update({
+			numpy.dtype("int64"): "(cl:quote (cl:signed-byte 64))",
+			numpy.dtype("int32"): "(cl:quote (cl:signed-byte 32))",
+			numpy.dtype("int16"): "(cl:quote (cl:signed-byte 16))",
+			numpy.dtype("int8"):  "(cl:quote (cl:signed-byte 8))",
+			numpy.dtype("uint64"): "(cl:quote (cl:unsigned-byte 64))",
+			numpy.dtype("uint32"): "(cl:quote (cl:unsigned-byte 32))",
+			numpy.dtype("uint16"): "(cl:quote (cl:unsigned-byte 16))",
+			numpy.dtype("uint8"):  "(cl:quote (cl:unsigned-byte 8))",
+			numpy.dtype("bool_"): "(cl:quote cl:bit)",
+			numpy.dtype("float64"): "(cl:quote cl:double-float)",
+			numpy.dtype("float32"): "(cl:quote cl:single-float)",
+			numpy.dtype("object"): "cl:t",
+		})
+		# Register the handlers to convert Python -> Lisp strings.
+		# numpy.integer covers u/int64/32/16/8 through the MRO.
+		_lispify.register(numpy.ndarray, customize_wrap_lispifier(lispify_ndarray))
+		_lispify.register(numpy.float64, customize_wrap_lispifier(lispify_float))
+		_lispify.register(numpy.float32, customize_wrap_lispifier(
+			lambda x : lispify_infnan_if_needed(str(x))))
+		_lispify.register(numpy.bool_, customize_wrap_lispifier(
+			lambda x : "1" if x else "0"))
+		_lispify.register(numpy.integer, str)
+		eval_globals["_py4cl_numpy"] = numpy
+
+	class LazyNumpyProxy(object):
+		"""Stands in for the numpy module in eval_globals until the
+		first attribute access, which triggers the real import."""
+		def __getattr__(self, attr):
+			init_numpy()
+			return getattr(numpy, attr)
 # end of "if numpy_is_installed" ###############################################
 
 def handle_lispifier (obj):
 	"""
 	Store an object in a dictionary, and return a handle
 	"""
-	handle = next(python_handle)
+	handle = next_python_handle()
 	python_objects[handle] = obj
 	return "#.(py4cl2::customize "                        + \
 		"(py4cl2::make-python-object-finalize :type " + \
-		"\"{0}\"".format(str(type(obj)))            + \
+		"\"{0}\"".format(str(obj.__class__))        + \
 		" :handle {0}".format(str(handle))          + \
 		"))"
 
@@ -361,17 +447,21 @@ def lispify(obj):
 	if return_values > 0:
 		if isinstance(obj, Exception): return str(obj)
 		else: return handle_lispifier(obj)
-
-	try:
-		if isinstance(obj, Exception):
-			return lispify_exception(obj)
-		elif numpy_is_installed and isinstance(obj, numpy.integer):
-			return str(obj)
-		else:
-			return lispifiers[type(obj)](obj)
-	except KeyError:
-		# Unknown type. Return a handle to a python object
-		return handle_lispifier(obj)
+	return _lispify(obj)
+
+# The type-specific lispifiers from the lispifiers dict are registered
+# on _lispify below, once the customize wrappers have been set up.
+# singledispatch caches the method resolution per class, so subclasses
+# (e.g. numpy scalar types) resolve without a failed dict lookup.
+@functools.singledispatch
+def _lispify(obj):
+	# If user code imported numpy itself (bypassing the _py4cl_numpy
+	# proxy), the numpy lispifiers may not be registered yet
+	if numpy_is_installed and not numpy_is_loaded and "numpy" in sys.modules:
+		init_numpy()
+		return _lispify(obj)
+	# Unknown type. Return a handle to a python object
+	return handle_lispifier(obj)
 
 def generator(function, stop_value):
 	temp = None
@@ -386,8 +476,8 @@ def recv_string():
 	"""
 	Get a string from the input stream
 	"""
-	length = int(sys.stdin.readline())
-	return sys.stdin.read(length)
+	length = int(input_stream.readline())
+	return input_stream.read(length)
 
 def recv_value():
 	"""
@@ -396,25 +486,43 @@ def recv_value():
 	"""
 	return eval(recv_string(), eval_globals)
 
+# Code objects for expressions and statements received from lisp.
+# Repeated pyeval/pyexec of the same string (e.g. on every iteration of
+# a loop on the lisp side) should not pay for re-parsing the source.
+code_cache = {}
+def compiled_code(source, mode):
+	key = (source, mode)
+	code = code_cache.get(key)
+	if code is None:
+		if len(code_cache) > 10000:
+			code_cache.clear()
+		code = compile(source, "<string>", mode)
+		code_cache[key] = code
+	return code
+
 send_value_lock = threading.RLock()
 def send_value(cmd_type, value):
 	"""
 	Send a value to stdout as a string, with length of string first
 	"""
 	with send_value_lock:
-		return_stream.write(cmd_type)
 		try:
 			# if type(value) == str and return_values > 0:
 			# value_str = value # to handle stringified-errors along with remote-objects
 			# else:
 			value_str = lispify(value)
 		except Exception as e:
-			# At this point the message type has been sent,
+			# The message type has already been decided,
 			# so we cannot change to throw an exception/signal condition
 			value_str = "Lispify error: {0}".format(lispify_exception(e))
-		excess_char_count = (0 if os.name != "nt" else value_str.count("\n"))
-		print(len(value_str)+excess_char_count, file = return_stream, flush=True)
-		return_stream.write(value_str)
+		# Coalesce the message type, header and payload into a single
+		# write + flush: one syscall per message instead of three.
+		# The header counts characters rather than bytes, because the
+		# lisp side reads the payload from a character stream. Binary
+		# writes do no newline translation, so no count correction is
+		# needed on windows either.
+		return_stream.write("{0}{1}\n{2}".format(
+			cmd_type, len(value_str), value_str).encode("utf-8"))
 		return_stream.flush()
 
 def return_value(value):
@@ -436,6 +544,29 @@ def pythonize(value): # assumes the symbol name is downcased by the lisp process
 	"""
 	return str(value)[1:].replace("-", "_")
 
+def dispatch_eval():
+	"""Evaluate an expression, returning its value"""
+	return_value(eval(compiled_code(recv_string(), "eval"), eval_globals))
+
+def dispatch_exec():
+	"""Execute a statement"""
+	exec(compiled_code(recv_string(), "exec"), eval_globals)
+	return_value(None)
+
+def dispatch_eval_many():
+	"""Evaluate several expressions, returning all values in one message"""
+	return_value(tuple(eval(compiled_code(expr, "eval"), eval_globals)
+					   for expr in recv_value()))
+
+# Message types with no control-flow implications, dispatched through a
+# single dict lookup. The remaining types (q, r, O, o) affect the loop
+# itself and stay inline below.
+message_handlers = {
+	"e": dispatch_eval,
+	"x": dispatch_exec,
+	"I": dispatch_eval_many,
+}
+
 def message_dispatch_loop():
 	"""
 	Wait for a message, dispatch on the type of message.
@@ -443,6 +574,8 @@ def message_dispatch_loop():
 
 	e  Evaluate an expression (expects string)
 	x  Execute a statement (expects string)
+	I  Evaluate several expressions (expects tuple of strings),
+	   returning all results in one message
 	q  Quit
 	"""
 	global return_values  # Controls whether values or handles are returned
@@ -450,24 +583,16 @@ def message_dispatch_loop():
 		try:
 			output_stream.flush()
 			# Read command type
-			cmd_type = sys.stdin.read(1)
+			cmd_type = input_stream.read(1)
 			# It is possible that python would have finished sending the data to CL
 			# but CL would still not have finished processing. We will receive further
 			# instructions only after CL has finished processing, and therefore we can delete
 			# the arrays. (TODO: But how does this happen with callbacks?)
 			if numpy_is_installed: delete_numpy_pickle_arrays()
 
-			if cmd_type == "e":  # Evaluate an expression
-				expr = recv_string()
-				# if expr not in cache:
-				# print("Adding " + expr + " to cache")
-				# cache[expr] = eval("lambda : " + expr, eval_globals)
-				# result = cache[expr]()
-				result = eval(expr, eval_globals)
-				return_value(result)
-			elif cmd_type == "x": # Execute a statement
-				exec(recv_string(), eval_globals)
-				return_value(None)
+			handler = message_handlers.get(cmd_type)
+			if handler is not None:
+				handler()
 			elif cmd_type == "q":
 				exit(0)
 			elif cmd_type == "r": # return value from lisp function
@@ -484,27 +609,48 @@ def message_dispatch_loop():
 		except Exception as e:
 			return_error(e)
 
-# Store for python objects which cannot be translated to Lisp objects
+# Store for python objects which cannot be translated to Lisp objects.
+# Handles freed from the lisp side are kept on a freelist and reused,
+# so long sessions do not keep allocating ever-larger integers.
 python_objects = {}
 python_handle = itertools.count(0)
+python_handle_freelist = []
+
+def next_python_handle():
+	if python_handle_freelist:
+		return python_handle_freelist.pop()
+	return next(python_handle)
+
+def free_python_object(handle):
+	# Called from the lisp side when a python-object handle is GCed.
+	# Must tolerate handles which are already gone (e.g. after a
+	# python restart).
+	if handle in python_objects:
+		del python_objects[handle]
+		python_handle_freelist.append(handle)
 
 # Make callback function accessible to evaluation
 eval_globals["_py4cl_LispCallbackObject"] = LispCallbackObject
 eval_globals["_py4cl_Symbol"] = Symbol
 eval_globals["_py4cl_UnknownLispObject"] = UnknownLispObject
 eval_globals["_py4cl_objects"] = python_objects
+eval_globals["_py4cl_free_handle"] = free_python_object
 eval_globals["_py4cl_generator"] = generator
 # These store the environment used when eval-ing strings from Lisp
 eval_globals["_py4cl_config"] = config
 eval_globals["_py4cl_load_config"] = load_config
+# Queried by NUMPY-INSTALLED-P on the lisp side, without importing numpy
+eval_globals["_py4cl_numpy_is_installed"] = numpy_is_installed
 if numpy_is_installed:
-	# NumPy is used for Lisp -> Python conversion of multidimensional arrays
-	eval_globals["_py4cl_numpy"] = numpy
+	# NumPy is used for Lisp -> Python conversion of multidimensional
+	# arrays; the proxy defers the import until numpy is actually used
+	eval_globals["_py4cl_numpy"] = LazyNumpyProxy()
 	eval_globals["_py4cl_load_pickled_ndarray"] \
 		= load_pickled_ndarray
+	eval_globals["_py4cl_ndarray_from_text"] \
+		= ndarray_from_text
 
 # Lisp-side customize-able lispifiers
-old_lispifiers = lispifiers.copy()
 def customize_wrap_lispifier(lispifier):
 	def _customize_wrap_lispifier(x):
 		lispified_value = lispifier(x)
@@ -512,7 +658,35 @@ def customize_wrap_lispifier(lispifier):
 	return _customize_wrap_lispifier
 
 for key in lispifiers:
-	lispifiers[key] = customize_wrap_lispifier(lispifiers[key])
+	_lispify.register(key, customize_wrap_lispifier(lispifiers[key]))
+
+# Exceptions are lispified as they are, without passing through
+# customize; the numpy lispifiers are registered from init_numpy
+_lispify.register(Exception, lispify_exception)
+
+# A type object absent from python_to_lisp_type (e.g. a user-defined
+# class) gets a handle, like any other unknown value
+_lispify_known_type = customize_wrap_lispifier(lispifiers[type])
+def lispify_type(x):
+	if x in lispified_types:
+		return _lispify_known_type(x)
+	return handle_lispifier(x)
+_lispify.register(type, lispify_type)
+
+# The wire strings for these singletons never change; compute them once
+# (customize wrapper included) and return module-level constants
+LISPIFIED_TRUE        = _lispify(True)
+LISPIFIED_FALSE       = _lispify(False)
+LISPIFIED_NONE        = _lispify(None)
+LISPIFIED_EMPTY_TUPLE = _lispify(())
+_lispify.register(bool, lambda x: LISPIFIED_TRUE if x else LISPIFIED_FALSE)
+_lispify.register(type(None), lambda x: LISPIFIED_NONE)
+_lispify_nonempty_tuple = _lispify.dispatch(tuple)
+def lispify_tuple_constant_aware(x):
+	if x:
+		return _lispify_nonempty_tuple(x)
+	return LISPIFIED_EMPTY_TUPLE
+_lispify.register(tuple, lispify_tuple_constant_aware)
 
 async_results = {}  # Store for function results. Might be Exception
 async_handle = itertools.count(0) # Running counter
@@ -149,6 +149,20 @@ will result in 'sys' name not defined PYERROR."
   (apply #'raw-py #\x strings)
   (values))
 
+(declaim (ftype (function (&rest string)) raw-pyeval-many))
+(defun raw-pyeval-many (&rest expressions)
+  "Calls python eval on each of EXPRESSIONS, as they are, without any
+pythonization or modification, in a single message exchange with the
+python process. Returns a list of the results. Useful for batching
+several small evaluations to avoid per-message round trip overhead."
+  (python-start-if-not-alive)
+  (let ((stream (uiop:process-info-input *python*)))
+    (bt:with-recursive-lock-held (*python-lock*)
+      (write-char #\I stream)
+      (stream-write-string (pythonize expressions) stream)
+      (force-output stream)
+      (dispatch-messages *python*))))
+
 (defun (setf raw-pyeval) (value &rest args)
   (apply #'raw-pyexec (append args
                               (list "=" (pythonize value))))
@@ -16,9 +16,10 @@ The list can include one or more of:
 ")
 
 (defun numpy-installed-p ()
-  (handler-case (progn
-                  (pyexec "import numpy")
-                  t)
+  ;; Queries a flag set up by py4cl.py rather than importing numpy:
+  ;; the python side defers the numpy import until it is actually
+  ;; needed, and an import here would defeat that.
+  (handler-case (and (pyeval "_py4cl_numpy_is_installed") t)
     (pyerror (condition)
       (declare (ignore condition))
       nil)))
@@ -24,6 +24,7 @@
    #:python-eof-but-alive
    #:python-eof-and-dead
    #:raw-pyeval
+   #:raw-pyeval-many
    #:raw-pyexec
    #:pyeval
    #:pyexec
@@ -39,12 +39,10 @@ HANDLE slot is a unique key used to refer to a value in python."
           (if (and
                (python-alive-p) ; If not alive, pyexec will start python
                (= *current-python-process-id* python-id))  ; Python might have restarted
-              ;; Call the internal function, to avoid infinite recursion or deadlock
-              (raw-pyexec "
-try:
-  del _py4cl_objects[" (%pythonize handle) "]
-except:
-  pass")))))
+              ;; Call the internal function, to avoid infinite recursion or deadlock.
+              ;; _py4cl_free_handle tolerates stale handles and puts the
+              ;; freed handle on a freelist for reuse.
+              (raw-pyexec "_py4cl_free_handle(" (%pythonize handle) ")")))))
 
 (defvar *numpy-pickle-index*)
 
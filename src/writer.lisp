@@ -98,6 +98,26 @@ which is interpreted correctly by python (3.7.2)."
                (write-to-string (imagpart obj))
                "j)"))
 
+(defun write-numpy-array-element (elt stream)
+  "Write ELT to STREAM in a form numpy can parse out of a
+space-separated data string: plain integers, or floats with an e
+exponent marker and inf/nan spelled out."
+  (if (floatp elt)
+      (cond ((float-features:float-nan-p elt)
+             (write-string "nan" stream))
+            ((or (= elt float-features:single-float-positive-infinity)
+                 (= elt float-features:double-float-positive-infinity))
+             (write-string "inf" stream))
+            ((or (= elt float-features:single-float-negative-infinity)
+                 (= elt float-features:double-float-negative-infinity))
+             (write-string "-inf" stream))
+            (t
+             (write-string (substitute-if #\e (lambda (ch)
+                                                (member ch '(#\d #\D #\f #\F #\s #\S #\l #\L)))
+                                          (write-to-string elt))
+                           stream)))
+      (princ elt stream)))
+
 (defvar *numpy-pickle-index* 0
   "Used for transferring multiple numpy-pickled arrays in one pyeval/exec/etc")
 ;; this is incremented by pythonize and reset to 0 at the beginning of
@@ -123,10 +143,11 @@ Is numpy installed on python side?"
                               ((unsigned-byte 16) . "uint16")
                               ((unsigned-byte  8) . "uint8")
                               (bit . "bool")))
-         (astype-string (if-let (type (cdr (assoc (array-element-type obj) cl-numpy-type-map
-                                                  :test #'type=)))
-                          (concatenate 'string ".astype('" type "')")
-                          "")))
+         (numpy-type (cdr (assoc (array-element-type obj) cl-numpy-type-map
+                                 :test #'type=)))
+         (astype-string (if numpy-type
+                            (concatenate 'string ".astype('" numpy-type "')")
+                            "")))
     (when (and (not (eq t (array-element-type obj)))
                (config-var 'numpy-pickle-lower-bound)
                (config-var 'numpy-pickle-location)
@@ -149,6 +170,21 @@ Is numpy installed on python side?"
     ;; Requires __array_interface__
     ;; Probable Required Reading: https://numpy.org/doc/stable/reference/arrays.interface.html
 
+    ;; Numeric arrays below the pickle bound go as one space-separated
+    ;; data string which numpy parses in C, rather than as a python
+    ;; list literal which eval would parse element by element.
+    (when (and numpy-type (plusp (array-rank obj)) (plusp (array-total-size obj)))
+      (return-from pythonize
+        (concatenate 'string
+                     "_py4cl_ndarray_from_text(\""
+                     (with-output-to-string (stream)
+                       (dotimes (indx (array-total-size obj))
+                         (unless (zerop indx) (write-char #\space stream))
+                         (write-numpy-array-element (row-major-aref obj indx) stream)))
+                     "\", \"" numpy-type "\", "
+                     (pythonize (array-dimensions obj))
+                     ")")))
+
     ;; Handle case of empty array
     (if (= (array-total-size obj) 0)
         (if (string/= "" astype-string)